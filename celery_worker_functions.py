@@ -1,5 +1,6 @@
 import mongo_db_logic as db
 import logging
+import gpt_logic
 
 from aws_logic import create_resume_document
 from short_url_logic import shorten_url
@@ -45,7 +46,8 @@ def generate_resume(conversation_id, sender_number, message_list):
     sms.send_message(
         message=link_message_text,
         conversation_id=conversation_id,
-        phone_number=sender_number
+        phone_number=sender_number,
+        channel=user.contact_method,
     )
 
     # save message to database
@@ -58,3 +60,7 @@ def generate_resume(conversation_id, sender_number, message_list):
 
     # update the user object to show that the resume has been generated
     user.update(is_resume_generated=True)
+
+    # report how the GPT calls for this worker's resumes have been routed and cached so far
+    gpt_logic.gpt_logic.log_route_stats()
+    gpt_logic.gpt_logic.prompt_registry.log_stats()
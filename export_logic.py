@@ -0,0 +1,308 @@
+"""Stream conversations out of MongoDB into chat-format JSONL for analytics and fine-tuning datasets
+
+Usage:
+    python export_logic.py output/conversations.jsonl --since 2023-07-01 --status active
+
+The export reads the raw ``user_data`` collection with pymongo instead of ``UserData.objects`` so that only the
+projected fields are ever loaded, and it pages through the collection by ``_id`` so memory use stays constant no
+matter how many conversations there are. After every batch the last exported ``_id`` is written to a watermark file,
+along with the size of the output file at that point, and re-running the same command truncates anything written
+by an unfinished batch and resumes from there.
+"""
+
+import argparse
+import datetime
+import json
+import logging
+import os
+import re
+
+from bson import ObjectId
+
+import mongo_db_logic as db
+from prompt_registry import get_prompt_registry
+from sms_encoding_logic import get_reply_budget
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Only the fields needed to build a training example (and to redact it) are read from the database
+EXPORT_PROJECTION = {
+    'messages': 1,
+    'created_at': 1,
+    'user_status': 1,
+    'user_name': 1,
+    'user_email': 1,
+    'user_phone_number': 1,
+    'contact_method': 1,
+}
+
+EMAIL_PATTERN = re.compile(r'[\w.+-]+@[\w-]+\.[\w.-]+')
+PHONE_PATTERN = re.compile(r'\+?\(?\d[\d\s().-]{7,}\d')
+URL_PATTERN = re.compile(r'https?://\S+')
+
+# The bot's first question asks for the user's name, and the user's next message answers it. Only questions about
+# the user's own name count, not e.g. "What is the name of the company you worked at?"
+NAME_QUESTION_PATTERN = re.compile(r'\byour\s+(?:first\s+|full\s+)?name\b[^?]*\?', re.IGNORECASE)
+# Lead-ins such as "Hi, my name is" or "I'm" before the name in the user's answer
+NAME_ANSWER_PREFIX_PATTERN = re.compile(
+    r"^\W*(?:(?:hi|hello|hey)\b\W*)?"
+    r"(?:(?:my\s+)?(?:first\s+|full\s+)?name\s+is|i\s*'?\s*a?m|it\s*'?\s*s|this\s+is|call\s+me)?\s*",
+    re.IGNORECASE
+)
+NAME_WORD_PATTERN = re.compile(r"[^\W\d_]+(?:['-][^\W\d_]+)*")
+# Words that can appear in an answer to the name question but are not part of the name
+NOT_NAME_WORDS = {
+    'yes', 'no', 'ok', 'okay', 'sure', 'hi', 'hello', 'hey', 'thanks', 'thank', 'you', 'please', 'i', 'am', 'my',
+    'name', 'is', 'its', 'it', 'the', 'a', 'and', 'but', 'from', 'here', 'want', 'need', 'would', 'like', 'mr',
+    'mrs', 'ms', 'dr', 'first', 'last', 'full', 'resume',
+}
+
+
+def _redact_phone_number(match):
+    """Redact a phone number match, leaving shorter digit runs such as year ranges (2013-2017) alone"""
+    digit_count = sum(character.isdigit() for character in match.group())
+    return '[PHONE]' if 10 <= digit_count <= 15 else match.group()
+
+
+def redact_pii(text, known_values=None):
+    """Replace emails, phone numbers, urls and any known user values in the text with placeholders
+
+    :param text: the text to redact
+    :param known_values: exact values belonging to the user mapped to their placeholder, e.g. {'John': '[NAME]'}
+    :return: the redacted text
+    """
+    text = EMAIL_PATTERN.sub('[EMAIL]', text)
+    text = URL_PATTERN.sub('[URL]', text)
+    text = PHONE_PATTERN.sub(_redact_phone_number, text)
+
+    # longest values first, so that "John Smith" is replaced as a whole before "John"
+    for value, placeholder in sorted((known_values or {}).items(), key=lambda item: len(item[0]), reverse=True):
+        if len(value.strip()) > 1:
+            text = re.sub(r'\b' + re.escape(value.strip()) + r'\b', placeholder, text, flags=re.IGNORECASE)
+
+    return text
+
+
+def extract_names_from_messages(messages):
+    """Find the names the user gave in reply to the bot asking for their name
+
+    :param messages: the raw messages of the conversation
+    :return: the name from every answer to a name question
+    """
+    names = []
+    for question, answer in zip(messages, messages[1:]):
+        if question['role'] != 'assistant' or answer['role'] != 'user':
+            continue
+        if not NAME_QUESTION_PATTERN.search(question['content']):
+            continue
+
+        # only the first clause after any lead-in, e.g. "John Smith" from "Hi, I'm John Smith. I'm a welder"
+        answer_text = NAME_ANSWER_PREFIX_PATTERN.sub('', answer['content'].strip())
+        first_clause = re.split(r'[,.!?;:\n]', answer_text, maxsplit=1)[0]
+
+        # the name is the run of words before the first word that can't be part of it
+        words = []
+        for word in NAME_WORD_PATTERN.findall(first_clause):
+            if word.lower() in NOT_NAME_WORDS:
+                break
+            words.append(word)
+
+        # a longer run is a sentence, not a name, and guessing from it would redact ordinary words
+        if 1 <= len(words) <= 4:
+            names.append(' '.join(words))
+
+    return names
+
+
+def build_query(since=None, until=None, status=None, after_id=None):
+    """Build the mongo filter for the export from the date, status and watermark arguments"""
+    query = {}
+
+    if after_id is not None:
+        query['_id'] = {'$gt': after_id}
+
+    created_at = {}
+    if since is not None:
+        created_at['$gte'] = since
+    if until is not None:
+        created_at['$lt'] = until
+    if created_at:
+        query['created_at'] = created_at
+
+    if status is not None:
+        query['user_status'] = status
+
+    return query
+
+
+def conversation_to_example(document, prompt_registry):
+    """Convert a raw user_data document into a chat-format training example
+
+    :return: a dict with a ``messages`` list, or None if the conversation has no messages
+    """
+    messages = document.get('messages') or []
+    if not messages:
+        return None
+
+    # user_name is only saved once a resume is generated, so names are also taken from the conversation itself.
+    # The words of user_name are redacted on their own as well so that e.g. a first name is removed wherever it
+    # appears, but names guessed from an answer are only redacted whole as they are less certain
+    user_name = document.get('user_name') or ''
+    known_values = {name: '[NAME]' for name in [user_name, *user_name.split(), *extract_names_from_messages(messages)]}
+    known_values[document.get('user_email') or ''] = '[EMAIL]'
+    known_values[document.get('user_phone_number') or ''] = '[PHONE]'
+    known_values.pop('', None)
+
+    # The system prompt is the current chat prompt for the conversation's channel, dated to when the conversation
+    # started. It is what a model trained on this data will be served, not necessarily what the model saw at the
+    # time: older conversations had the date first and no length budget. It is not counted in the registry's cache stats
+    # as it is never sent to the api
+    length_requirement = ''
+    budget = get_reply_budget(document.get('contact_method'))
+    if budget is not None:
+        length_requirement = prompt_registry.prompts['length_requirement'].format(
+            max_characters=budget['max_characters']
+        )
+
+    created_at = document.get('created_at') or datetime.datetime.utcnow()
+    system_prompt = prompt_registry.render(
+        'chat', extra_instructions=length_requirement, date=created_at.date(), record_prefix=False
+    )
+
+    example_messages = [{'role': 'system', 'content': system_prompt}]
+    for message in messages:
+        example_messages.append({
+            'role': message['role'],
+            'content': redact_pii(message['content'], known_values),
+        })
+
+    return {'messages': example_messages}
+
+
+def read_watermark(watermark_path):
+    """Read the last exported _id, the output file size at that point and the export's filters from the watermark
+
+    :return: a (last_id, offset, filters) tuple, or (None, 0, None) if there is no watermark
+    """
+    if not os.path.exists(watermark_path):
+        return None, 0, None
+
+    with open(watermark_path, 'r') as f:
+        watermark = json.load(f)
+
+    return ObjectId(watermark['last_id']), watermark['offset'], watermark['filters']
+
+
+def write_watermark(watermark_path, last_id, offset, filters):
+    """Atomically record the last exported _id, the output file size and the filters so that an interrupted export
+    can resume"""
+    temp_path = watermark_path + '.tmp'
+    with open(temp_path, 'w') as f:
+        json.dump({'last_id': str(last_id), 'offset': offset, 'filters': filters}, f)
+    os.replace(temp_path, watermark_path)
+
+
+def describe_filters(since=None, until=None, status=None):
+    """Get the export's filters in the form they are stored in the watermark"""
+    return {
+        'since': since.isoformat() if since else None,
+        'until': until.isoformat() if until else None,
+        'status': status,
+    }
+
+
+def export_conversations(output_path, since=None, until=None, status=None, batch_size=500, watermark_path=None,
+                         resume=True):
+    """Export conversations to a JSONL file, one chat-format example per line
+
+    :param output_path: path of the JSONL file to write
+    :param since: only export conversations created on or after this datetime
+    :param until: only export conversations created before this datetime
+    :param status: only export conversations with this user_status
+    :param batch_size: number of documents fetched from the database per query
+    :param watermark_path: file the last exported _id is stored in, defaults to ``<output_path>.watermark``
+    :param resume: continue from the watermark instead of starting a new export
+    :return: the number of conversations written
+    """
+    watermark_path = watermark_path or output_path + '.watermark'
+    filters = describe_filters(since, until, status)
+    last_id, offset, watermark_filters = read_watermark(watermark_path) if resume else (None, 0, None)
+
+    if last_id is not None:
+        # resuming with other filters would mix the results of two different exports in one file
+        if watermark_filters != filters:
+            raise ValueError(f"The export in {output_path} was started with filters {watermark_filters}, not "
+                             f"{filters}. Use the same filters to resume it or --restart to start a new export")
+        if not os.path.exists(output_path):
+            logger.warning(f"{output_path} no longer exists, starting a new export instead of resuming")
+            last_id, offset = None, 0
+        elif os.path.getsize(output_path) < offset:
+            raise ValueError(f"{output_path} is shorter than when the watermark was written, so it can't be resumed. "
+                             f"Use --restart to start a new export")
+
+    prompt_registry = get_prompt_registry()
+    collection = db.UserData._get_collection()
+
+    exported = 0
+    # when resuming, keep the examples from completed batches and drop anything an unfinished batch wrote after them
+    with open(output_path, 'r+b' if last_id is not None else 'wb') as f:
+        if last_id is not None:
+            logger.info(f"Resuming export after _id {last_id} at offset {offset}")
+            f.truncate(offset)
+            f.seek(offset)
+
+        while True:
+            # each batch is a fresh query from the watermark, so no cursor stays open for the whole export
+            cursor = collection.find(
+                build_query(since, until, status, last_id),
+                projection=EXPORT_PROJECTION,
+            ).sort('_id', 1).limit(batch_size)
+
+            batch_count = 0
+            for document in cursor:
+                batch_count += 1
+                last_id = document['_id']
+                example = conversation_to_example(document, prompt_registry)
+                if example is not None:
+                    f.write((json.dumps(example, ensure_ascii=False) + "\n").encode('utf-8'))
+                    exported += 1
+
+            if batch_count == 0:
+                break
+
+            f.flush()
+            os.fsync(f.fileno())
+            write_watermark(watermark_path, last_id, f.tell(), filters)
+            logger.info(f"Exported {exported} conversations, watermark {last_id}")
+
+    return exported
+
+
+def parse_date(value):
+    """Parse a YYYY-MM-DD command line argument into a datetime"""
+    return datetime.datetime.strptime(value, '%Y-%m-%d')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Export conversations as chat-format JSONL")
+    parser.add_argument('output_path', help="path of the JSONL file to write")
+    parser.add_argument('--since', type=parse_date, help="only export conversations created on or after YYYY-MM-DD")
+    parser.add_argument('--until', type=parse_date, help="only export conversations created before YYYY-MM-DD")
+    parser.add_argument('--status', choices=['active', 'suspended'], help="only export users with this status")
+    parser.add_argument('--batch-size', type=int, default=500, help="documents fetched per database query")
+    parser.add_argument('--watermark', help="watermark file, defaults to <output_path>.watermark")
+    parser.add_argument('--restart', action='store_true', help="ignore the watermark and start a new export")
+    args = parser.parse_args()
+
+    count = export_conversations(
+        output_path=args.output_path,
+        since=args.since,
+        until=args.until,
+        status=args.status,
+        batch_size=args.batch_size,
+        watermark_path=args.watermark,
+        resume=not args.restart,
+    )
+    logger.info(f"Export complete, {count} conversations written to {args.output_path}")
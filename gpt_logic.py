@@ -1,22 +1,65 @@
-import datetime
+import argparse
 import json
 import os
+import re
+import time
 import tiktoken
 import logging
 
 from openai import ChatCompletion
+from openai.error import InvalidRequestError
+
+from prompt_registry import get_prompt_registry, PromptRegistry
+from sms_encoding_logic import get_reply_budget, cut_at_last_sentence
+
+# A name is one to four words made of letters, optionally joined by spaces, dots, apostrophes or hyphens
+NAME_PATTERN = re.compile(r"[^\W\d_]+(?:[ .'-]+[^\W\d_]+){0,3}\.?")
+# Matches lines such as "Name: John Smith", "**Name**: John Smith" or "- Full Name - Jane Doe" in a summary.
+# Only spaces and tabs are allowed around the label so that an empty "Name:" line doesn't match the line after it
+NAME_LINE_PATTERN = re.compile(
+    r"^[ \t*#-]*(?:full[ \t]+)?name[ \t*]*[:-][ \t*]*(.+?)[ \t]*$", re.IGNORECASE | re.MULTILINE
+)
+# Answers that fit NAME_PATTERN but mean the name is missing
+PLACEHOLDER_NAMES = {
+    'not provided', 'not given', 'not specified', 'not available', 'not mentioned', 'unknown', 'n/a', 'na', 'none',
+    'null', 'no name', 'anonymous', 'user', 'the user', 'name', 'john doe', 'jane doe',
+}
+
+# Calls, escalations and latency of every backend per call type, shared by every GPTLogic in the process
+ROUTE_STATS = {}
+# Number of routed calls between logging the route stats
+ROUTE_STATS_LOG_INTERVAL = 100
 
 
 class GPTLogic:
     """contains the logic for the different types of prompts we can ask the job-seeker"""
     api_key = os.environ['OPENAI_API_KEY']
 
-    def __init__(self):
+    def __init__(self, route_stats: dict = None, prompt_registry: PromptRegistry = None):
         self.davinci_model = "text-davinci-003"
         self.functions_chat_model = "gpt-3.5-turbo-0613"
         self.chat_model = "gpt-3.5-turbo"
-        self.prompts = self.load_prompts_from_file()
+        self.full_model = "gpt-4"
+        # same models with a larger context window, only used when the prompt or answer doesn't fit
+        self.large_context_models = {
+            self.chat_model: "gpt-3.5-turbo-16k",
+            self.functions_chat_model: "gpt-3.5-turbo-16k-0613",
+        }
+        self.prompt_registry = get_prompt_registry() if prompt_registry is None else prompt_registry
+        self.prompts = self.prompt_registry.prompts
         self.functions = self.get_functions()
+
+        # each call type is tried on its backends in order, cheapest first, until one is confident enough.
+        # A backend that runs out of context is retried on its large context model before moving on
+        self.confidence_threshold = 0.8
+        self.routes = {
+            'get_user_name': ['local', self.chat_model, self.full_model],
+            'summarize_messages': [self.chat_model, self.full_model],
+            'chat': [self.functions_chat_model],
+            # the resume's max_tokens alone nearly fills gpt-3.5-turbo's context, so start on the large context model
+            'generate_resume': [self.large_context_models[self.chat_model], self.full_model],
+        }
+        self.route_stats = ROUTE_STATS if route_stats is None else route_stats
         logging.basicConfig(level=logging.INFO)
 
     def api_call(self, prompt: list, model: str, temperature: int, functions: list = None,
@@ -48,6 +91,9 @@ class GPTLogic:
                 max_tokens=max_tokens,
             )
 
+        # count how much of the prompt the api served from its cache
+        self.prompt_registry.record_usage(response.get('usage'))
+
         # Process function call
         response_message = response["choices"][0]["message"]
         if response_message.get("function_call"):
@@ -66,12 +112,201 @@ class GPTLogic:
 
         return response
 
-    def chat(self, messages_dict: list) -> dict:
-        """chat with the user using the gpt-3.5-turbo model"""
-        prompt = [{"role": "system", "content": self.get_prompt('chat')}] + messages_dict
+    def chat(self, messages_dict: list, channel: str = None) -> dict:
+        """chat with the user using the gpt-3.5-turbo model, keeping the reply within the channel's length budget"""
+        length_requirement = ''
+        max_tokens = None
+
+        budget = get_reply_budget(channel)
+        if budget is not None:
+            length_requirement = self.prompts['length_requirement'].format(max_characters=budget['max_characters'])
+            max_tokens = budget['max_tokens']
+
+        finish_reasons = []
+
+        def validate(content, finish_reason):
+            finish_reasons.append(finish_reason)
+            return self.complete_answer_confidence(content, finish_reason)
+
+        prompt = [
+            {"role": "system", "content": self.get_prompt('chat', extra_instructions=length_requirement)}
+        ] + messages_dict
         logging.info(prompt)
-        response = self.api_call(prompt, self.functions_chat_model, 0, self.functions)
-        return response['choices'][0]['message']
+        message = self.route('chat', prompt, 0, functions=self.functions, max_tokens=max_tokens, validate=validate)
+        if finish_reasons[-1] != 'length':
+            return message
+
+        # the reply hit the channel's max_tokens, so ask once more for a shorter one
+        logging.info("Chat reply was cut off by the length budget, asking for a shorter reply")
+        shorter_requirement = length_requirement + self.prompts['shorter_requirement']
+        prompt[0] = {"role": "system", "content": self.get_prompt('chat', extra_instructions=shorter_requirement)}
+        message = self.route('chat', prompt, 0, functions=self.functions, max_tokens=max_tokens, validate=validate)
+        if finish_reasons[-1] == 'length':
+            logging.info("Shorter chat reply was cut off too, sending it up to its last complete sentence")
+            message = {**message, 'content': cut_at_last_sentence(message['content'])}
+        return message
+
+    def route(self, call_type: str, prompt: list, temperature: float, functions: list = None, max_tokens: int = None,
+              local=None, validate=None) -> dict:
+        """Send a call to the cheapest backend for its call type, escalating while the answer is not confident
+
+        :param call_type: key of self.routes naming the backends to try in order
+        :param prompt: messages to send to the model backends
+        :param temperature: sampling temperature for the model backends
+        :param functions: functions to pass to the model backends
+        :param max_tokens: maximum number of tokens for the model backends to generate
+        :param local: function returning the content for the 'local' backend, or None if it can't answer
+        :param validate: function scoring (content, finish_reason) between 0 and 1, defaults to trusting any answer
+        :return: the message from the first confident backend, or the last answer given if none were confident
+        """
+        fallback_message = None
+        for backend in self.routes[call_type]:
+            start_time = time.perf_counter()
+            finish_reason = 'stop'
+
+            if backend == 'local':
+                content = local() if local is not None else None
+                message = {'role': 'assistant', 'content': content} if content else None
+            else:
+                message, finish_reason = self.call_model(call_type, prompt, backend, temperature, functions, max_tokens)
+
+            if message is None:
+                confidence = 0.0
+            elif validate is None:
+                confidence = 1.0
+            else:
+                confidence = validate(message.get('content'), finish_reason)
+
+            latency = time.perf_counter() - start_time
+            self.record_route_stats(call_type, backend, latency, confidence)
+            logging.info(f"{call_type} routed to {backend} with confidence {confidence} in {latency:.2f}s")
+            if confidence >= self.confidence_threshold:
+                return message
+            if message is not None:
+                fallback_message = message
+
+        if fallback_message is None:
+            raise RuntimeError(f"No backend was able to answer {call_type}")
+        return fallback_message
+
+    def call_model(self, call_type: str, prompt: list, model: str, temperature: float, functions: list = None,
+                   max_tokens: int = None) -> tuple:
+        """Call a model, retrying on its large context model only if the prompt or answer didn't fit
+
+        A low confidence answer is not retried here. The large context model is the same model, so it would
+        most likely give the same answer at a higher price.
+
+        :return: the message (None if the call failed) and the finish reason
+        """
+        try:
+            response = self.api_call(prompt, model, temperature, functions, max_tokens)
+        except InvalidRequestError as e:
+            if 'context' not in str(e) or model not in self.large_context_models:
+                logging.warning(f"{call_type} failed on {model}: {e}")
+                return None, None
+            logging.info(f"{call_type} prompt doesn't fit {model}, retrying with a larger context window")
+            return self.call_model(call_type, prompt, self.large_context_models[model], temperature, functions,
+                                   max_tokens)
+
+        choice = response['choices'][0]
+        finish_reason = choice.get('finish_reason', 'stop')
+
+        # without a max_tokens of our own, a cut off answer means the model ran out of context window
+        if finish_reason == 'length' and max_tokens is None and model in self.large_context_models:
+            logging.info(f"{call_type} answer ran out of context on {model}, retrying with a larger context window")
+            return self.call_model(call_type, prompt, self.large_context_models[model], temperature, functions,
+                                   max_tokens)
+
+        return choice['message'], finish_reason
+
+    def record_route_stats(self, call_type: str, backend: str, latency: float, confidence: float):
+        """Record the latency of a routed call and whether it had to be escalated"""
+        stats = self.route_stats.setdefault(call_type, {}).setdefault(
+            backend, {'calls': 0, 'escalations': 0, 'total_latency': 0.0}
+        )
+        stats['calls'] += 1
+        stats['total_latency'] += latency
+        if confidence < self.confidence_threshold:
+            stats['escalations'] += 1
+
+        total_calls = sum(stats['calls'] for backends in self.route_stats.values() for stats in backends.values())
+        if total_calls % ROUTE_STATS_LOG_INTERVAL == 0:
+            self.log_route_stats()
+
+    def get_route_stats(self) -> dict:
+        """Get the number of calls, escalation rate and mean latency in seconds of every backend per call type"""
+        return {
+            call_type: {
+                backend: {
+                    'calls': stats['calls'],
+                    'escalation_rate': stats['escalations'] / stats['calls'],
+                    'mean_latency': stats['total_latency'] / stats['calls'],
+                }
+                for backend, stats in backends.items()
+            }
+            for call_type, backends in self.route_stats.items()
+        }
+
+    def log_route_stats(self):
+        """Log the calls, escalation rate and mean latency of every backend per call type"""
+        for call_type, backends in self.get_route_stats().items():
+            for backend, stats in backends.items():
+                logging.info(f"Route {call_type} -> {backend}: {stats['calls']} calls, "
+                             f"{stats['escalation_rate']:.0%} escalated, {stats['mean_latency']:.2f}s mean latency")
+
+    def evaluate_routes(self, eval_set_path: str = 'router_eval_set.json') -> dict:
+        """Measure the accuracy and latency of every backend of every call type in the evaluation set
+
+        Each case in the evaluation set holds the keyword arguments of the call and either the exact
+        ``expected`` answer or a list of strings the answer is ``expected_contains``. Every backend is
+        run on its own, without escalation, so the results show what each route can handle. The runs
+        use a separate GPTLogic with its own route stats and prompt registry so they don't show up in the
+        production stats.
+
+        :param eval_set_path: path of the JSON evaluation set keyed by call type
+        :return: accuracy and mean latency in seconds of every backend per call type
+        """
+        with open(eval_set_path, 'r') as f:
+            eval_set = json.load(f)
+
+        evaluator = GPTLogic(route_stats={}, prompt_registry=PromptRegistry())
+        results = {}
+        for call_type, cases in eval_set.items():
+            results[call_type] = {}
+            for backend in self.routes[call_type]:
+                # force every case onto this backend alone
+                evaluator.routes[call_type] = [backend]
+                correct = 0
+                total_latency = 0.0
+                for case in cases:
+                    start_time = time.perf_counter()
+                    try:
+                        answer = getattr(evaluator, call_type)(**case['inputs'])
+                    except RuntimeError:
+                        answer = None
+                    total_latency += time.perf_counter() - start_time
+                    correct += self.is_correct_answer(answer, case)
+
+                results[call_type][backend] = {
+                    'accuracy': correct / len(cases),
+                    'mean_latency': total_latency / len(cases),
+                }
+                logging.info(f"Evaluated {call_type} -> {backend}: {results[call_type][backend]}")
+
+        return results
+
+    @staticmethod
+    def is_correct_answer(answer, case: dict) -> bool:
+        """Check an answer against an evaluation case, ignoring case and surrounding whitespace"""
+        if isinstance(answer, dict):
+            answer = answer.get('content')
+        if not answer:
+            return False
+
+        answer = answer.strip().lower()
+        if 'expected' in case:
+            return answer == case['expected'].strip().lower()
+        return all(expected.lower() in answer for expected in case['expected_contains'])
 
     @staticmethod
     def get_functions():
@@ -91,60 +326,80 @@ class GPTLogic:
         ]
         return functions
 
-    @staticmethod
-    def load_prompts_from_file():
-        with open('prompt_library.json', 'r') as f:  # load prompts from file
-            data = json.load(f)
-
-        return data
-
-    def get_prompt(self, method):
-        """get the prompt for the given method and add the current date to the context prompt"""
-        today_date = str(datetime.datetime.now())
-        context = self.prompts["context"] + today_date + "\n"
-
-        return context + self.prompts[method]
+    def get_prompt(self, method, user_context='', extra_instructions=''):
+        """get the prompt for the given method with the static instructions first and today's date and the
+        user's content last, so that consecutive calls share a cacheable prefix"""
+        return self.prompt_registry.render(method, user_context=user_context, extra_instructions=extra_instructions)
 
     def summarize_messages(self, messages: list) -> str:
         prompt = [
-            {"role": "system", "content": self.get_prompt('summarize_messages') + "```\n" + str(messages) + "\n```"}
+            {"role": "system", "content": self.get_prompt('summarize_messages', "```\n" + str(messages) + "\n```")}
         ]
         logging.info(f"summarize_messages gptlogic file Messages: {messages}")
         logging.info(f"summarize_message gptlogic Prompt: {prompt}")
-        response = self.api_call(prompt, self.chat_model, 0)
-        return response['choices'][0]['message']['content']
+        message = self.route('summarize_messages', prompt, 0, validate=self.complete_answer_confidence)
+        return message['content']
 
     def generate_resume(self, resume_inputs: list, user_phone_number) -> str:
         prompt = [
             {
                 "role": "system",
-                "content": self.get_prompt('generate_resume')
-                           + f"```\nPhone Number: {user_phone_number}. \n Resume Inputs: {resume_inputs}```"
+                "content": self.get_prompt(
+                    'generate_resume',
+                    f"```\nPhone Number: {user_phone_number}. \n Resume Inputs: {resume_inputs}```"
+                )
             },
         ]
         logging.info("Generating Resume")
         logging.info(prompt)
 
-        response = ChatCompletion.create(
-            model=self.chat_model,
-            messages=prompt,
-            functions=self.functions,
-            function_call="auto",
-            temperature=0.5,
-            max_tokens=3500,
-        )
-        return response['choices'][0]['message']['content']
+        message = self.route('generate_resume', prompt, 0.5, max_tokens=3500, validate=self.complete_answer_confidence)
+        return message['content']
 
     def get_user_name(self, summary_text: str) -> str:
         prompt = [
             {
                 "role": "system",
-                "content": self.get_prompt('get_user_name')
-                           + f"```{summary_text}```\nName: "}
+                "content": self.get_prompt('get_user_name', f"Information:\n```{summary_text}```\nName: ")}
         ]
         logging.info(prompt)
-        response = self.api_call(prompt, self.chat_model, 0, None)
-        return response['choices'][0]['message']['content']
+        message = self.route(
+            'get_user_name',
+            prompt,
+            0,
+            local=lambda: self.extract_user_name(summary_text),
+            validate=lambda content, finish_reason: self.name_confidence(content),
+        )
+        return message['content'].strip()
+
+    @staticmethod
+    def extract_user_name(summary_text: str):
+        """Pull the user's name out of a summary without calling the api
+
+        Only a "Name: ..." line is trusted. Headings are not, as they are as often "RESUME SUMMARY" as a name.
+
+        :param summary_text: the summary produced by summarize_messages
+        :return: the name, or None if it couldn't be found
+        """
+        match = NAME_LINE_PATTERN.search(summary_text)
+        if match:
+            return match.group(1).strip('*"\' ')
+
+        return None
+
+    @staticmethod
+    def name_confidence(name) -> float:
+        """Score how much a string looks like a person's name rather than a sentence, placeholder or empty answer"""
+        if not name or name.strip(' .').lower() in PLACEHOLDER_NAMES:
+            return 0.0
+        return 1.0 if NAME_PATTERN.fullmatch(name.strip()) else 0.0
+
+    @staticmethod
+    def complete_answer_confidence(content, finish_reason) -> float:
+        """Score an answer that must be non-empty and not cut off by the token limit"""
+        if not content or not content.strip():
+            return 0.0
+        return 1.0 if finish_reason == 'stop' else 0.5
 
 
 def num_tokens_from_messages(messages, tokenizer):
@@ -155,3 +410,11 @@ def num_tokens_from_messages(messages, tokenizer):
 
 
 gpt_logic = GPTLogic()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Measure the accuracy and latency of every GPT call route")
+    parser.add_argument('eval_set_path', nargs='?', default='router_eval_set.json', help="JSON evaluation set")
+    args = parser.parse_args()
+
+    print(json.dumps(gpt_logic.evaluate_routes(args.eval_set_path), indent=4))
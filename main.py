@@ -1,11 +1,11 @@
 """SMS chatbot that helps create a resume using GPT-3 and Twilio Conversations API"""
-import json
 import logging
 from sms_logic import SMSLogic
 from fastapi import FastAPI, Request
 from fastapi.responses import JSONResponse
 import mongo_db_logic as db
 import gpt_logic
+from prompt_registry import get_prompt_registry
 from pydantic import BaseModel, Field
 from celery_worker_functions import generate_resume
 
@@ -13,6 +13,7 @@ app = FastAPI()
 user_data = db.UserData.objects
 sms = SMSLogic()
 gpt = gpt_logic.GPTLogic()
+prompts = get_prompt_registry().prompts
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -88,13 +89,13 @@ async def receive_sms(request: Request):
         logging.info(f"User has exceeded the message limit Phone: {user.user_phone_number} ")
         user.user_status = 'suspended'
 
-        with open('prompt_library.json', 'r') as f:
-            user_suspension_message = json.load(f)["user_suspension_message"]
+        user_suspension_message = prompts["user_suspension_message"]
 
         sms.send_message(
             message=user_suspension_message,
             conversation_id=conversation_id,
-            phone_number=sender_number
+            phone_number=sender_number,
+            channel=message.Source,
         )
 
         db.save_message_to_database(
@@ -106,15 +107,15 @@ async def receive_sms(request: Request):
 
     elif user.user_status == 'suspended':
         logging.info(f"User has been suspended Phone: {user.user_phone_number} ")
-        with open('prompt_library.json', 'r') as f:
-            user_suspension_message = json.load(f)["user_suspension_message"]
+        user_suspension_message = prompts["user_suspension_message"]
 
         if user.messages[-1].content == user_suspension_message:
             return {'message': 'User suspended'}
         sms.send_message(
             message=user_suspension_message,
             conversation_id=conversation_id,
-            phone_number=sender_number
+            phone_number=sender_number,
+            channel=message.Source,
         )
 
         db.save_message_to_database(
@@ -132,7 +133,7 @@ async def receive_sms(request: Request):
         message_list = [dict(message.to_mongo()) for message in message_objects]
 
         # Get the response from the GPT-3 chatbot
-        gpt_response_string = gpt.chat(message_list)['content']
+        gpt_response_string = gpt.chat(message_list, channel=message.Source)['content']
 
         db.save_message_to_database(
             conversation_id=conversation_id,
@@ -151,17 +152,18 @@ async def receive_sms(request: Request):
             sms.send_message(
                 message=gpt_response_string,
                 conversation_id=conversation_id,
-                phone_number=sender_number
+                phone_number=sender_number,
+                channel=message.Source,
             )
 
     elif user.is_resume_generated:
         logging.info("Resume already generated")
-        with open('prompt_library.json', 'r') as f:  # load prompts from file
-            canned_end_message = json.load(f)["canned_end_message"]
+        canned_end_message = prompts["canned_end_message"]
         sms.send_message(
             message=canned_end_message,
             conversation_id=conversation_id,
-            phone_number=sender_number
+            phone_number=sender_number,
+            channel=message.Source,
         )
 
         db.save_message_to_database(
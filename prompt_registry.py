@@ -0,0 +1,152 @@
+"""Registry of the prompts in prompt_library.json, assembled so that every call shares a stable cacheable prefix
+
+Upstream prompt caching only helps when consecutive requests start with the same tokens. Each system prompt is
+therefore built from the static instructions first (the shared context followed by the method's instructions), and
+the parts that change between calls come last: the date, at day granularity, and then the user's own content.
+
+Two numbers are kept. The cached token rate is what the api reports it served from its cache, and is the one that
+shows whether caching works. The repeated prefix rate only counts how often a static prefix was rendered before in
+this process, which is an upper bound on what the upstream cache could hit, not a measurement of it.
+"""
+
+import datetime
+import functools
+import hashlib
+import json
+import logging
+
+import tiktoken
+
+# Number of rendered prompts between logging the registry stats
+STATS_LOG_INTERVAL = 100
+
+
+class PromptTemplate:
+    """A precompiled prompt whose static prefix is fixed for the lifetime of the process"""
+
+    def __init__(self, name: str, static_prefix: str, model: str):
+        self.name = name
+        self.static_prefix = static_prefix
+        self.model = model
+        # the version changes whenever the prompt text does, so logs show exactly which prompt was used
+        self.version = hashlib.sha256(static_prefix.encode('utf-8')).hexdigest()[:12]
+        self._token_length = None
+
+    @property
+    def token_length(self) -> int:
+        """Number of tokens in the static prefix, counted once on first use"""
+        if self._token_length is None:
+            encoding = tiktoken.encoding_for_model(self.model)
+            self._token_length = len(encoding.encode(self.static_prefix))
+        return self._token_length
+
+
+class PromptRegistry:
+    """Load prompt_library.json once and render system prompts with the static instructions first"""
+
+    # keys of the library that are not the instructions for a GPT method
+    non_template_keys = ('context', 'date_context', 'format_requirement', 'length_requirement',
+                         'shorter_requirement', 'canned_end_message', 'user_suspension_message')
+
+    def __init__(self, prompt_library_path: str = 'prompt_library.json', model: str = 'gpt-3.5-turbo'):
+        with open(prompt_library_path, 'r') as f:  # load prompts from file
+            self.prompts = json.load(f)
+
+        self.templates = {
+            name: PromptTemplate(name, self.prompts['context'] + instructions, model)
+            for name, instructions in self.prompts.items()
+            if name not in self.non_template_keys and isinstance(instructions, str)
+        }
+        self.render_count = 0
+        self.repeated_prefix_count = 0
+        self.seen_prefixes = set()
+        self.prompt_tokens = 0
+        self.cached_prompt_tokens = 0
+
+    def render(self, name: str, user_context: str = '', extra_instructions: str = '', date=None,
+               record_prefix: bool = True) -> str:
+        """Render a system prompt as static instructions, then the date, then the user's content
+
+        :param name: name of the prompt in the library, e.g. 'chat'
+        :param user_context: content specific to this call, such as the messages to summarize
+        :param extra_instructions: instructions that are fixed per configuration, such as a channel's length budget
+        :param date: date to tell the model it is, defaults to today
+        :param record_prefix: count the prompt in the repeated prefix rate, turn off for prompts never sent to the api
+        :return: the system prompt
+        """
+        template = self.templates[name]
+        prefix = template.static_prefix + extra_instructions
+        if record_prefix:
+            self.record_prefix(prefix)
+
+        date = date or datetime.date.today()
+        date_line = self.prompts['date_context'].format(date=date.isoformat())
+
+        logging.debug(f"Rendering prompt {name} version {template.version}")
+        return prefix + date_line + user_context
+
+    def record_prefix(self, prefix: str):
+        """Count whether this static prefix was already rendered earlier in the process"""
+        prefix_hash = hashlib.sha256(prefix.encode('utf-8')).digest()
+        self.render_count += 1
+        if prefix_hash in self.seen_prefixes:
+            self.repeated_prefix_count += 1
+        else:
+            self.seen_prefixes.add(prefix_hash)
+
+        if self.render_count % STATS_LOG_INTERVAL == 0:
+            self.log_stats()
+
+    def record_usage(self, usage):
+        """Add the prompt tokens of an api response, and how many of them the api served from its cache
+
+        :param usage: the ``usage`` of the api response, cached tokens are in ``prompt_tokens_details``
+        """
+        if not usage:
+            return
+        self.prompt_tokens += usage.get('prompt_tokens', 0)
+        self.cached_prompt_tokens += (usage.get('prompt_tokens_details') or {}).get('cached_tokens', 0)
+
+    def repeated_prefix_rate(self) -> float:
+        """Fraction of rendered prompts whose static prefix was rendered before in this process
+
+        This ignores the date line and whether the api actually cached anything, so it is only an upper bound
+        on prefix cache hits. Use cached_token_rate for what the api reports.
+        """
+        if self.render_count == 0:
+            return 0.0
+        return self.repeated_prefix_count / self.render_count
+
+    def cached_token_rate(self) -> float:
+        """Fraction of prompt tokens sent to the api that it reported as served from its prompt cache"""
+        if self.prompt_tokens == 0:
+            return 0.0
+        return self.cached_prompt_tokens / self.prompt_tokens
+
+    def get_stats(self) -> dict:
+        """Get the cache stats along with the version and prefix token length of every template"""
+        return {
+            'cached_token_rate': self.cached_token_rate(),
+            'prompt_tokens': self.prompt_tokens,
+            'repeated_prefix_rate': self.repeated_prefix_rate(),
+            'renders': self.render_count,
+            'templates': {
+                name: {'version': template.version, 'token_length': template.token_length}
+                for name, template in self.templates.items()
+            },
+        }
+
+    def log_stats(self):
+        """Log the cache stats and the version and prefix token length of every template"""
+        stats = self.get_stats()
+        logging.info(f"Prompt cache served {stats['cached_token_rate']:.0%} of {stats['prompt_tokens']} prompt tokens, "
+                     f"{stats['repeated_prefix_rate']:.0%} of {stats['renders']} prompts repeated a static prefix")
+        for name, template_stats in stats['templates'].items():
+            logging.info(f"Prompt {name} version {template_stats['version']}: "
+                         f"{template_stats['token_length']} prefix tokens")
+
+
+@functools.lru_cache(maxsize=None)
+def get_prompt_registry(prompt_library_path: str = 'prompt_library.json') -> PromptRegistry:
+    """Get the registry for a prompt library, loading the file only the first time it is asked for"""
+    return PromptRegistry(prompt_library_path)
@@ -0,0 +1,144 @@
+"""GSM-7 normalization and segment counting for outbound SMS text
+
+A single character outside the GSM-7 alphabet (a curly quote, an em dash, an emoji) makes the carrier send the whole
+message as UCS-2, which drops a segment from 160 to 70 characters. Replies going out over SMS are normalized to GSM-7
+here, and the chat prompt is given a length budget so that replies fit in a target number of segments.
+"""
+
+import logging
+import math
+import re
+import unicodedata
+
+# Characters in the GSM 03.38 basic alphabet, each costs one septet
+GSM7_BASIC_CHARS = set(
+    "@£$¥èéùìòÇ\nØø\rÅåΔ_ΦΓΛΩΠΨΣΘΞÆæßÉ !\"#¤%&'()*+,-./0123456789:;<=>?"
+    "¡ABCDEFGHIJKLMNOPQRSTUVWXYZÄÖÑÜ§¿abcdefghijklmnopqrstuvwxyzäöñüà"
+)
+# Characters in the GSM 03.38 extension table, each costs two septets (escape + character)
+GSM7_EXTENDED_CHARS = set("^{}\\[~]|€\f")
+
+# Common characters GPT produces that have a close GSM-7 equivalent
+GSM7_REPLACEMENTS = {
+    '‘': "'", '’': "'", '‚': "'", '‛': "'", '′': "'", '`': "'",
+    '“': '"', '”': '"', '„': '"', '‟': '"', '″': '"', '«': '"', '»': '"',
+    '‐': '-', '‑': '-', '‒': '-', '–': '-', '—': '-', '―': '-', '−': '-',
+    '…': '...', '•': '-', '·': '-', '●': '-', '▪': '-',
+    '\u00a0': ' ', '\u2002': ' ', '\u2003': ' ', '\u2009': ' ', '\u202f': ' ', '\u3000': ' ',
+    '\u200b': '', '\u200d': '', '\ufe0f': '', '\t': ' ',
+    '™': 'TM', '©': '(c)', '®': '(R)', '×': 'x', '→': '->',
+}
+
+GSM7_SINGLE_SEGMENT_LENGTH = 160
+GSM7_MULTI_SEGMENT_LENGTH = 153
+UCS2_SINGLE_SEGMENT_LENGTH = 70
+UCS2_MULTI_SEGMENT_LENGTH = 67
+
+# Number of segments a chat reply should fit in for each channel, channels not listed are not budgeted
+CHANNEL_SEGMENT_BUDGETS = {
+    'sms': 3,
+}
+# Rough number of characters per token for English text, used to turn a character budget into max_tokens
+CHARACTERS_PER_TOKEN = 4
+
+
+def is_sms_channel(channel) -> bool:
+    """Check if a channel (Twilio message source or user contact method) is SMS"""
+    return (channel or '').lower() == 'sms'
+
+
+def is_gsm7(text: str) -> bool:
+    """Check if every character of the text can be sent in the GSM-7 alphabet"""
+    return all(character in GSM7_BASIC_CHARS or character in GSM7_EXTENDED_CHARS for character in text)
+
+
+def to_gsm7_character(character: str) -> str:
+    """Get the GSM-7 text for a character, an empty string if it has no equivalent"""
+    if character in GSM7_BASIC_CHARS or character in GSM7_EXTENDED_CHARS:
+        return character
+    if character in GSM7_REPLACEMENTS:
+        return GSM7_REPLACEMENTS[character]
+
+    # strip accents, e.g. "ç" -> "c", keeping only the parts that are in the alphabet
+    decomposed = unicodedata.normalize('NFKD', character)
+    return ''.join(part for part in decomposed if part in GSM7_BASIC_CHARS)
+
+
+def drops_letters(text: str) -> bool:
+    """Check if normalizing the text to GSM-7 would remove letters or digits, e.g. Arabic or Cyrillic text"""
+    return any(
+        unicodedata.category(character)[0] in 'LN' and not to_gsm7_character(character)
+        for character in text
+    )
+
+
+def normalize_to_gsm7(text: str) -> str:
+    """Replace or remove every character that would force the text to be sent as UCS-2
+
+    Characters with a close equivalent are replaced, accented letters outside the alphabet lose their accent,
+    and anything else (such as emoji) is dropped.
+    """
+    normalized = [to_gsm7_character(character) for character in text]
+
+    # dropping emoji can leave doubled spaces or trailing spaces at the end of lines
+    lines = [re.sub(' {2,}', ' ', line).rstrip() for line in ''.join(normalized).split('\n')]
+    return '\n'.join(lines).strip()
+
+
+def count_sms_segments(text: str) -> int:
+    """Count the number of SMS segments the text will be billed as"""
+    if is_gsm7(text):
+        length = sum(2 if character in GSM7_EXTENDED_CHARS else 1 for character in text)
+        single_segment_length, multi_segment_length = GSM7_SINGLE_SEGMENT_LENGTH, GSM7_MULTI_SEGMENT_LENGTH
+    else:
+        # UCS-2 is counted in UTF-16 code units, so emoji outside the basic plane take two
+        length = len(text.encode('utf-16-le')) // 2
+        single_segment_length, multi_segment_length = UCS2_SINGLE_SEGMENT_LENGTH, UCS2_MULTI_SEGMENT_LENGTH
+
+    if length <= single_segment_length:
+        return 1
+    return math.ceil(length / multi_segment_length)
+
+
+def get_reply_budget(channel):
+    """Get the character and token budget a chat reply on this channel should fit in
+
+    :param channel: Twilio message source or user contact method, e.g. 'SMS' or 'WHATSAPP'
+    :return: a dict with max_characters and max_tokens, or None if the channel is not budgeted
+    """
+    segments = CHANNEL_SEGMENT_BUDGETS.get((channel or '').lower())
+    if segments is None:
+        return None
+
+    max_characters = segments * GSM7_MULTI_SEGMENT_LENGTH
+    # max_tokens is a hard cut-off, so leave headroom over the length asked for in the prompt
+    return {
+        'max_characters': max_characters,
+        'max_tokens': 2 * max_characters // CHARACTERS_PER_TOKEN,
+    }
+
+
+def cut_at_last_sentence(text: str) -> str:
+    """Cut a reply that was stopped by the token limit back to its last complete sentence"""
+    text = text.rstrip()
+    sentence_ends = [match.end() for match in re.finditer(r'[.!?](?=\s|$)', text)]
+    if sentence_ends:
+        return text[:sentence_ends[-1]]
+
+    # no complete sentence at all, so mark the reply as cut off instead of dropping it
+    return text + '...'
+
+
+def prepare_outbound_text(text: str, channel) -> str:
+    """Prepare a message for sending on a channel, normalizing it to GSM-7 when it goes out over SMS
+
+    Text that would lose letters (non-Latin scripts) or end up empty is sent unchanged as UCS-2 instead.
+    """
+    if not is_sms_channel(channel):
+        return text
+
+    normalized = normalize_to_gsm7(text)
+    if not normalized or drops_letters(text):
+        logging.info("Text can't be normalized to GSM-7 without losing content, sending it as UCS-2")
+        return text
+    return normalized
@@ -1,9 +1,11 @@
 """Twilio SMS logic to send and receive messages with the help of GPTLogic and store them in MongoDB"""
 
+import logging
 import os
 from twilio.rest import Client
 import gpt_logic
 import mongo_db_logic as db
+from sms_encoding_logic import prepare_outbound_text, count_sms_segments, is_sms_channel, CHANNEL_SEGMENT_BUDGETS
 
 
 
@@ -17,8 +19,19 @@ class SMSLogic:
         self.gpt_logic = gpt_logic.GPTLogic()
 
 
-    def send_message(self, conversation_id, message, phone_number):
-        """Send a content to the user and save it to their user data in the database"""
+    def send_message(self, conversation_id, message, phone_number, channel='sms'):
+        """Send a content to the user, normalized to GSM-7 when the channel is SMS"""
+        message = prepare_outbound_text(message, channel)
+        if not message or not message.strip():
+            logging.warning(f"Not sending an empty message to conversation {conversation_id}")
+            return
+
+        if is_sms_channel(channel):
+            segments = count_sms_segments(message)
+            logging.info(f"Sending SMS of {len(message)} characters in {segments} segments")
+            if segments > CHANNEL_SEGMENT_BUDGETS['sms']:
+                logging.warning(f"SMS to conversation {conversation_id} exceeds the segment budget: {segments}")
+
         self.client.conversations \
             .v1 \
             .conversations(conversation_id) \